@@ -8,13 +8,12 @@ Contains SQLAlchemy classes.
 """
 import os
 from sqlalchemy import (ForeignKey, Column, Integer, String, Float,
-                        DateTime, Boolean)
+                        DateTime, Boolean, text)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import (scoped_session, sessionmaker, relationship,
-                            backref, reconstructor)
+                            backref, reconstructor, object_session)
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.types import TypeDecorator
 
 
@@ -26,11 +25,33 @@ Session = scoped_session(sessionmaker())
 _missing = object()   # sentinel object for missing values
 
 
+#
+# Name of the filesystem containing a directory, followed by the names
+# of the directory's ancestors, top first, and the directory itself.
+# The root directory of a filesystem is its own parent and has no name.
+#
+_ancestors = text("""WITH RECURSIVE ancestor(id, parent_id, name, depth) AS (
+    SELECT id, parent_id, name, 0 FROM directory WHERE id = :id
+    UNION ALL
+    SELECT d.id, d.parent_id, d.name, a.depth + 1
+    FROM directory AS d JOIN ancestor AS a ON d.id = a.parent_id
+    WHERE a.id != a.parent_id)
+SELECT name FROM (
+    SELECT f.name AS name, NULL AS depth
+    FROM filesystem AS f JOIN directory AS d ON f.id = d.filesystem_id
+    WHERE d.id = :id
+    UNION ALL
+    SELECT name, depth FROM ancestor WHERE name != '')
+ORDER BY depth IS NOT NULL, depth DESC""")
+
+
 class cached_hybrid_property(hybrid_property):
     def __get__(self, instance, owner):
         if instance is None:
             # getting the property for the class
-            return self.expr(owner)
+            if self.expr is None:
+                return self
+            return super().__get__(instance, owner)
         else:
             # getting the property for an instance
             name = self.fget.__name__
@@ -63,22 +84,22 @@ class Directory(Base):
     __tablename__ = 'directory'
 
     id = Column(Integer, primary_key=True)
-    filesystem_id = Column(Integer, ForeignKey('filesystem.id'), nullable=False)
+    filesystem_id = Column(Integer, ForeignKey('filesystem.id'), nullable=False, index=True)
     parent_id = Column(Integer, ForeignKey(id), nullable=False, index=True)
     nfiles = Column(Integer, nullable=False, default=0)
     name = Column(String, nullable=False)
+    _fullpath = Column('fullpath', String)
 
     filesystem = relationship('FileSystem', back_populates='directories')
 
     children = relationship("Directory",
-                            cascade="all, delete-orphan",  # cascade deletions
                             # many to one + adjacency list - remote_side is
                             # required to reference the 'remote' column
                             # in the join condition.
                             backref=backref("parent", remote_side=id),
-                            # children will be represented as a dictionary
-                            # on the "name" attribute.
-                            collection_class=attribute_mapped_collection("name"))
+                            # children are only loaded on request, as a
+                            # plain list.
+                            lazy='select')
 
     def __repr__(self):
         return ("<Directory(id={0.id:d}, " +
@@ -90,16 +111,33 @@ class Directory(Base):
     @cached_hybrid_property
     def fullpath(self):
         """Full system directory path.
+
+        The path is normally stored when the directory is scanned, and is
+        only reconstructed from the parent directories if it is missing.
+        For a directory in the database, that takes a single query.
         """
+        if self._fullpath is not None:
+            return self._fullpath
+        session = object_session(self)
+        if session is not None and self.id is not None:
+            names = session.execute(_ancestors, {'id': self.id}).scalars().all()
+            if names:
+                return os.path.join(*names)
         if not self.name:
             return self.filesystem.name
+        #
+        # Collect names from the bottom up, then reverse them once.
+        #
         fp = [self.name]
         parent = self.parent
         while parent.name:
-            fp.insert(0, parent.name)
+            fp.append(parent.name)
             parent = parent.parent
-        fp.insert(0, self.filesystem.name)
-        return os.path.join(*fp)
+        return os.path.join(self.filesystem.name, *reversed(fp))
+
+    @fullpath.expression
+    def fullpath(cls):
+        return cls._fullpath
 
 
 FileSystem.directories = relationship('Directory', back_populates='filesystem')
@@ -111,7 +149,7 @@ class File(Base):
     __tablename__ = 'file'
 
     id = Column(Integer, primary_key=True)
-    directory_id = Column(Integer, ForeignKey('directory.id'), nullable=False)
+    directory_id = Column(Integer, ForeignKey('directory.id'), nullable=False, index=True)
     # mode = Column(String(10), nullable=False)
     # uid = Column(Integer, ForeignKey('users.uid'), nullable=False)
     # gid = Column(Integer, ForeignKey('groups.gid'), nullable=False)
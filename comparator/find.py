@@ -7,10 +7,77 @@ comparator.find
 Utilities for scanning a filesystem.
 """
 import os
-from .db import Session, Directory, File
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from .db import Session
 
 
-def walk(top):
+#
+# Ingest bypasses the ORM; columns are listed in the order rows are built.
+#
+_insert_directory = ("INSERT INTO directory (id, filesystem_id, parent_id, nfiles, name, fullpath) " +
+                     "VALUES (?, ?, ?, ?, ?, ?)")
+_insert_file = ("INSERT INTO file (directory_id, size, mtime, name, link, destination) " +
+                "VALUES (?, ?, ?, ?, ?, ?)")
+
+
+def _scandir(top, stat=False):
+    """List the contents of a single directory for :func:`walk`.
+
+    Parameters
+    ----------
+    top : :class:`str`
+        Directory to list.
+    stat : :class:`bool`, optional
+        If ``True``, look up the status of non-directory entries, so that
+        :meth:`os.DirEntry.stat` later returns a cached value.
+
+    Returns
+    -------
+    :class:`tuple`
+        A list of subdirectories and a list of other entries, or ``None``
+        if `top` could not be read.
+    """
+    dirs = []
+    nondirs = []
+
+    # We may not have read permission for top, in which case we can't
+    # get a list of the files the directory contains.  os.walk
+    # always suppressed the exception then, rather than blow up for a
+    # minor reason when (say) a thousand readable directories are still
+    # left to visit.  That logic is copied here, and applies equally to
+    # errors raised while reading the directory.
+    try:
+        with os.scandir(top) as scandir_it:
+            for entry in scandir_it:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    # If is_dir() raises an OSError, consider that the entry is not
+                    # a directory, same behaviour than os.path.isdir().
+                    is_dir = False
+
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    nondirs.append(entry)
+    except OSError as error:
+        return None
+
+    if stat:
+        for entry in nondirs:
+            try:
+                if not entry.is_symlink():
+                    entry.stat(follow_symlinks=False)
+            except OSError:
+                # Leave the error to be raised again by the caller.
+                pass
+
+    return dirs, nondirs
+
+
+def walk(top, workers=1, stat=False):
     """Simplified directory tree generator.
 
     Adapted from :func:`os.walk`, the yield is similar, but symbolic
@@ -26,57 +93,137 @@ def walk(top):
     list of :class:`os.DirEntry` objects for subdirectories in dirpath
     (excluding '.' and '..'). ``filenames`` is a list of :class:`os.DirEntry`
     objects for the non-directory files in ``dirpath``.
-    """
-    dirs = []
-    nondirs = []
 
-    # We may not have read permission for top, in which case we can't
-    # get a list of the files the directory contains.  os.walk
-    # always suppressed the exception then, rather than blow up for a
-    # minor reason when (say) a thousand readable directories are still
-    # left to visit.  That logic is copied here.
-    try:
-        scandir_it = os.scandir(top)
-    except OSError as error:
+    Parameters
+    ----------
+    top : :class:`str`
+        Top of the directory tree.
+    workers : :class:`int`, optional
+        If greater than one, list directories in this many threads.
+    stat : :class:`bool`, optional
+        If ``True``, look up the status of every entry in ``filenames``
+        while listing the directory.
+
+    Notes
+    -----
+    With one worker, the tree is traversed top-down, in the same order as
+    :func:`os.walk`, but with an explicit stack rather than recursion.
+    With more than one, the tree is traversed breadth-first, and
+    directories already queued are listed ahead of being yielded.  In both
+    cases a directory is always yielded before any of its subdirectories,
+    and subdirectories are only queued after the yield, so, as with
+    :func:`os.walk`, removing entries from ``dirnames`` prevents them from
+    being visited.
+
+    Unlike :func:`os.walk`, subdirectories are not checked again for being
+    symbolic links before they are visited; the type found when their
+    parent was listed is used.
+    """
+    if workers > 1:
+        yield from _walk_threaded(top, workers, stat)
         return
+    stack = deque([top])
+    while stack:
+        top = stack.pop()
+        listing = _scandir(top, stat)
+        if listing is None:
+            continue
+        dirs, nondirs = listing
 
-    with scandir_it:
-        while True:
-            try:
-                try:
-                    entry = next(scandir_it)
-                except StopIteration:
-                    break
-            except OSError as error:
-                return
+        yield top, dirs, nondirs
 
-            try:
-                is_dir = entry.is_dir(follow_symlinks=False)
-            except OSError:
-                # If is_dir() raises an OSError, consider that the entry is not
-                # a directory, same behaviour than os.path.isdir().
-                is_dir = False
+        # Push sub-directories in reverse, so they are popped in order.
+        # Symlinks were already excluded by is_dir(follow_symlinks=False),
+        # so there is no need for the os.path.islink() check in os.walk.
+        stack.extend(d.path for d in reversed(dirs))
+
+
+def _walk_threaded(top, workers, stat):
+    """Breadth-first version of :func:`walk` that lists directories in threads.
 
-            if is_dir:
-                dirs.append(entry)
-            else:
-                nondirs.append(entry)
+    Only directory listing, and optionally :meth:`os.DirEntry.stat`, happen
+    in the worker threads.  Results are yielded in the calling thread, in
+    the order the directories were found, so a single consumer can write
+    them to the database.
+
+    Parameters
+    ----------
+    top : :class:`str`
+        Top of the directory tree.
+    workers : :class:`int`
+        Number of worker threads.
+    stat : :class:`bool`
+        Passed to :func:`_scandir`.
+    """
+    waiting = deque([top])
+    running = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while waiting or running:
+            #
+            # Limit the number of listings held in memory.
+            #
+            while waiting and len(running) < 2*workers:
+                path = waiting.popleft()
+                running.append((path, executor.submit(_scandir, path, stat)))
+            top, future = running.popleft()
+            listing = future.result()
+            if listing is None:
+                continue
+            dirs, nondirs = listing
 
-    yield top, dirs, nondirs
+            yield top, dirs, nondirs
 
-    # Recurse into sub-directories
-    for d in dirs:
-        new_path = os.path.join(top, d.name)
-        # Issue #23605: os.path.islink() is used instead of caching
-        # entry.is_symlink() result during the loop on os.scandir() because
-        # the caller can replace the directory entry during the "yield"
-        # above.
-        if not os.path.islink(new_path):
-            yield from walk(new_path)
+            waiting.extend(d.path for d in dirs)
 
 
-def directories(fs, directory_id=1):
-    """Find all physical directories on filesystem `fs`.
+def _insert(statement, rows):
+    """Insert `rows` with the database driver, inside the current transaction.
+
+    Parameters
+    ----------
+    statement : :class:`str`
+        An ``INSERT`` statement with positional parameters.
+    rows : :class:`list`
+        A list of :class:`tuple`, one per row.
+    """
+    cursor = Session.connection().connection.cursor()
+    cursor.executemany(statement, rows)
+    cursor.close()
+
+
+def _file_rows(directory_id, entries, rows):
+    """Convert directory entries into rows of the ``file`` table.
+
+    This is the innermost loop of a scan, so it avoids a function call
+    per entry.
+
+    Parameters
+    ----------
+    directory_id : :class:`int`
+        The id of the directory containing `entries`.
+    entries : iterable
+        Non-directory entries, as :class:`os.DirEntry`.
+    rows : :class:`list`
+        Rows, as tuples of the columns in ``_insert_file``, are appended
+        to this list.
+    """
+    append = rows.append
+    readlink = os.readlink
+    for entry in entries:
+        #
+        # is_symlink() is answered from the directory listing where the platform
+        # supports it, and otherwise its lstat() is cached for stat() below.
+        #
+        if entry.is_symlink():
+            append((directory_id, 0, 0, entry.name, True, readlink(entry.path)))
+        else:
+            st = entry.stat(follow_symlinks=False)
+            append((directory_id, st.st_size, int(st.st_mtime), entry.name, False, ''))
+
+
+def directories(fs, directory_id=1, batch_size=10000, skip_files=False,
+                workers=1):
+    """Find all physical directories on filesystem `fs`, and the files they contain.
 
     Parameters
     ----------
@@ -84,6 +231,13 @@ def directories(fs, directory_id=1):
         The filesystem to scan.
     directory_id : :class:`int`, optional
         The id number of the directory corresponding to the root of `fs`.
+    batch_size : :class:`int`, optional
+        Insert rows into the database in batches of this size.
+    skip_files : :class:`bool`, optional
+        If ``True``, only record directories, not the files in them.
+    workers : :class:`int`, optional
+        Number of threads used to read directories, see :func:`walk`.
+        Database writes always happen in the calling thread.
 
     Returns
     -------
@@ -91,46 +245,144 @@ def directories(fs, directory_id=1):
         The id of the last directory found.  If scanning multiple filesystems,
         add one (1) to this number to set the `directory_id` for top of the
         next filesystem.
+
+    Notes
+    -----
+    The number of files in a directory is only known once that directory
+    is visited, so the row for a directory is not constructed until then.
+    Directories that are found but cannot be read are inserted at the end,
+    with zero files.
+
+    Files are recorded from the same directory listing used to find
+    subdirectories, so the filesystem is only traversed once.
+
+    Rows are written with the database driver's ``executemany()`` rather
+    than through the ORM, in the same transaction as `Session`.  The
+    transaction is not committed, so that several filesystems can be
+    recorded in one transaction.
     """
-    parents = {fs.name: directory_id}
-    Session.add(Directory(id=directory_id, filesystem_id=fs.id,
-                          parent_id=parents[fs.name], name=''))
-    Session.commit()
-    for dirpath, dirnames, filenames in walk(fs.name):
-        p = Session.query(Directory).filter(Directory.id == parents[dirpath]).one()
-        p.nfiles = len(filenames)
+    #
+    # Map path -> (id, parent_id, name) for directories found but not yet visited.
+    #
+    pending = {fs.name: (directory_id, directory_id, '')}
+    rows = []
+    file_rows = []
+    for dirpath, dirnames, filenames in walk(fs.name, workers=workers,
+                                             stat=(workers > 1 and not skip_files)):
+        i, parent_id, name = pending.pop(dirpath)
+        rows.append((i, fs.id, parent_id, len(filenames), name, dirpath))
         for d in dirnames:
             directory_id += 1
-            parents[os.path.join(dirpath, d.name)] = directory_id
-            Session.add(Directory(id=directory_id, filesystem_id=fs.id,
-                                  parent_id=parents[dirpath], name=d.name))
-        Session.commit()
+            pending[d.path] = (directory_id, i, d.name)
+        if not skip_files:
+            _file_rows(i, filenames, file_rows)
+        if len(rows) >= batch_size:
+            _insert(_insert_directory, rows)
+            rows.clear()
+        if len(file_rows) >= batch_size:
+            _insert(_insert_file, file_rows)
+            file_rows.clear()
+    for dirpath, (i, parent_id, name) in pending.items():
+        rows.append((i, fs.id, parent_id, 0, name, dirpath))
+    if rows:
+        _insert(_insert_directory, rows)
+    if file_rows:
+        _insert(_insert_file, file_rows)
     return directory_id
 
 
-def files(directory):
+def _scan_files(directory_id, path):
+    """Convert the non-directory entries in `path` into rows of the ``file`` table.
+
+    This does not touch the database, so it is safe to call from a
+    worker thread.
+
+    Parameters
+    ----------
+    directory_id : :class:`int`
+        The id of the directory.
+    path : :class:`str`
+        Full path to the directory.
+
+    Returns
+    -------
+    :class:`list`
+        Rows, as tuples of the columns in ``_insert_file``.
+    """
+    with os.scandir(path) as it:
+        entries = [entry for entry in it if not entry.is_dir(follow_symlinks=False)]
+    rows = []
+    _file_rows(directory_id, entries, rows)
+    return rows
+
+
+def files(directory, batch_size=10000):
     """Find files in `directory`; identify symlinks.
 
     Parameters
     ----------
     directory : :class:`Directory`
         Directory to scan with :func:`os.scandir()`.
+    batch_size : :class:`int`, optional
+        Insert rows into the database in batches of this size.
+
+    Notes
+    -----
+    Entries are read and inserted `batch_size` at a time, so memory use
+    does not depend on the size of the directory.  As with
+    :func:`directories`, the transaction is not committed.
     """
-    p = directory.fullpath
-    with os.scandir(p) as it:
-        for entry in it:
-            if not entry.is_dir(follow_symlinks=False):
-                if entry.is_symlink():
-                    d = os.readlink(os.path.join(p, entry.name))
-                    f = File(directory_id=directory.id,
-                             size=0, mtime=0,
-                             name=entry.name,
-                             link=True, destination=d)
-                else:
-                    st = entry.stat(follow_symlinks=False)
-                    f = File(directory_id=directory.id,
-                             size=st.st_size,
-                             mtime=int(st.st_mtime),
-                             name=entry.name)
-                Session.add(f)
-    Session.commit()
+    rows = []
+    with os.scandir(directory.fullpath) as it:
+        entries = (entry for entry in it if not entry.is_dir(follow_symlinks=False))
+        while True:
+            _file_rows(directory.id, islice(entries, batch_size), rows)
+            if not rows:
+                break
+            _insert(_insert_file, rows)
+            rows.clear()
+
+
+def all_files(directories, batch_size=10000, workers=1):
+    """Find files in each of `directories`.
+
+    Parameters
+    ----------
+    directories : iterable
+        Directories to scan with :func:`os.scandir()`.  Any object with
+        ``id`` and ``fullpath`` attributes will do, for example
+        :class:`Directory` or a query result row with those columns.
+    batch_size : :class:`int`, optional
+        Insert rows into the database in batches of this size.
+    workers : :class:`int`, optional
+        If greater than one, read directories in this many threads.
+        Database access always happens in the calling thread.
+
+    Notes
+    -----
+    As with :func:`directories`, the transaction is not committed.
+    """
+    if workers <= 1:
+        for d in directories:
+            files(d, batch_size)
+        return
+    waiting = iter(directories)
+    running = deque()
+    rows = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            #
+            # Limit the number of listings held in memory.
+            #
+            for d in waiting:
+                running.append(executor.submit(_scan_files, d.id, d.fullpath))
+                if len(running) >= 2*workers:
+                    break
+            if not running:
+                break
+            rows += running.popleft().result()
+            if len(rows) >= batch_size:
+                _insert(_insert_file, rows)
+                rows.clear()
+    if rows:
+        _insert(_insert_file, rows)
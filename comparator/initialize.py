@@ -8,10 +8,57 @@ Obtain filesystem metadata necessary for comparing the same data set
 at different locations.
 """
 import os
-from sqlalchemy import create_engine, func
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from sys import argv
+from argparse import ArgumentParser
+from sqlalchemy import create_engine, event, func, inspect, text
 from .db import engine, Session, Base, FileSystem, Directory, File
-from .find import directories, files
+from .find import directories, all_files
+
+
+def _sqlite_pragma(dbapi_connection, connection_record):
+    """Tune SQLite for a single, large, write-once scan.
+
+    Parameters
+    ----------
+    dbapi_connection : :class:`sqlite3.Connection`
+        The raw database connection.
+    connection_record : :class:`sqlalchemy.pool.ConnectionRecord`
+        Connection pool information, not used.
+    """
+    cursor = dbapi_connection.cursor()
+    #
+    # page_size only affects a new database, and must be set before
+    # switching to WAL.
+    #
+    cursor.execute("PRAGMA page_size=32768")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-262144")
+    cursor.execute("PRAGMA mmap_size=1073741824")
+    cursor.execute("PRAGMA locking_mode=EXCLUSIVE")
+    cursor.close()
+
+
+def _upgrade_schema(engine):
+    """Bring a database created by an earlier version up to date.
+
+    Parameters
+    ----------
+    engine : :class:`sqlalchemy.engine.Engine`
+        Connection to the database.
+
+    Notes
+    -----
+    Databases created before full paths were stored lack the
+    ``directory.fullpath`` column.  It is added, and left empty for
+    existing rows, whose paths are then reconstructed on demand by
+    :attr:`comparator.db.Directory.fullpath`.
+    """
+    columns = [c['name'] for c in inspect(engine).get_columns('directory')]
+    if 'fullpath' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE directory ADD COLUMN fullpath VARCHAR"))
 
 
 def _options():
@@ -21,8 +68,6 @@ def _options():
     -------
     The parsed options.
     """
-    from sys import argv
-    from argparse import ArgumentParser
     xct = os.path.basename(argv[0])
     desc = "Obtain filesystem metadata necessary for comparing the same data set at different locations."
     prsr = ArgumentParser(description=desc, prog=xct)
@@ -31,6 +76,9 @@ def _options():
                       help='FileSystem(s) to examine.')
     prsr.add_argument('-F', '--skip-files', action='store_true',
                       dest='skip_files', help='Skip the file search stage.')
+    prsr.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                      dest='jobs', metavar='N',
+                      help='Read directories in N threads (default %(default)s).')
     # prsr.add_argument('-l', '--log-dir', dest='logging', metavar='DIR',
     #                   default=os.path.join(os.environ['HOME'], 'Documents', 'Logs'),
     #                   help='Log files in DIR (default %(default)s).')
@@ -68,61 +116,93 @@ def main():
     if options.overwrite and os.path.exists(options.database):
         os.remove(options.database)
     engine = create_engine('sqlite:///'+options.database, echo=options.verbose)
+    event.listen(engine, 'connect', _sqlite_pragma)
     Session.remove()
+    #
+    # Rows are written directly, in bulk, so there is nothing for the
+    # session to flush before a query, and nothing stale after a commit.
+    #
     Session.configure(bind=engine, autocommit=False,
-                      autoflush=True, expire_on_commit=True)
+                      autoflush=False, expire_on_commit=False)
     Base.metadata.create_all(engine)
+    _upgrade_schema(engine)
     #
     # Add filesystems.
     #
-    try:
-        q = Session.query(FileSystem).one()
-    except NoResultFound:
-        Session.add_all([FileSystem(name=os.path.join(root, options.release))
-                         for root in options.filesystem])
+    if Session.query(FileSystem.id).limit(1).scalar() is None:
+        #
+        # Drop repeated -f options, but keep the order they were given.
+        # Filesystems that do not exist here are still recorded, because
+        # they may be scanned at another site.
+        #
+        names = dict.fromkeys(os.path.join(root, options.release)
+                              for root in (options.filesystem or []))
+        Session.bulk_save_objects([FileSystem(name=name) for name in names])
         Session.commit()
     #
-    # Scan Directories.
+    # Check each filesystem once; these may be slow network mounts.
+    #
+    fs_list = [(fs, os.path.exists(fs.name)) for fs in Session.query(FileSystem).all()]
+    #
+    # On a first scan, build secondary indexes after loading, rather than
+    # updating them row by row.
+    #
+    indexes = [ix for table in Base.metadata.sorted_tables
+               for ix in table.indexes if not ix.unique]
+    if Session.query(Directory.id).limit(1).scalar() is None:
+        for ix in indexes:
+            ix.drop(Session.connection(), checkfirst=True)
+    #
+    # Scan each filesystem.  Files are normally found while scanning
+    # directories; they are only scanned separately for filesystems whose
+    # directories were recorded by an earlier run with --skip-files.
+    # Each filesystem is committed as soon as it is scanned, so that an
+    # error only loses the filesystem being scanned.
     #
     last_id = 0
-    for fs in Session.query(FileSystem).all():
-        if os.path.exists(fs.name):
-            try:
-                q = Session.query(Directory).filter(Directory.filesystem_id == fs.id).one()
-            except NoResultFound:
-                last_id = directories(fs, last_id+1)
-            except MultipleResultsFound:
-                last_id = Session.query(func.max(Directory.id)).scalar()
-            else:
+    for fs, exists in fs_list:
+        if not exists:
+            continue
+        if Session.query(Directory.id).filter(Directory.filesystem_id == fs.id).limit(1).scalar() is None:
+            last_id = directories(fs, last_id+1,
+                                  skip_files=options.skip_files,
+                                  workers=options.jobs)
+            Session.commit()
+        else:
+            #
+            # Already scanned.  The release directory in the filesystem
+            # may be present but empty, so there may be only one directory.
+            # Continue numbering after the highest id in use; directory.id
+            # is the rowid, so SQLite finds its maximum without a scan.
+            #
+            last_id = Session.query(func.max(Directory.id)).scalar()
+            if (not options.skip_files and
+                    Session.query(File.id).join(Directory).filter(Directory.filesystem_id == fs.id).limit(1).scalar() is None):
                 #
-                # Apparently there was exactly one directory.
-                # This is not as weird as it sounds, because the release
-                # directory in the filesystem may be present but empty.
+                # Stream (id, fullpath) rows instead of loading every Directory.
+                # Directories recorded before full paths were stored need
+                # Directory objects, so that the path can be reconstructed.
                 #
-                last_id = q.id
-    #
-    # Scan files.
-    #
-    if not options.skip_files:
-        for fs in Session.query(FileSystem).all():
-            if os.path.exists(fs.name):
-                try:
-                    q = Session.query(File).join(Directory).filter(Directory.filesystem_id == fs.id).one()
-                except NoResultFound:
-                    for d in Session.query(Directory).filter(Directory.filesystem_id == fs.id).filter(Directory.nfiles > 0).all():
-                        files(d)
-                except MultipleResultsFound:
-                    #
-                    # Already scanned.
-                    #
-                    pass
-                else:
-                    #
-                    # Apparently there was exactly one file.  OK, fine.
-                    #
-                    pass
+                q = Session.query(Directory.id, Directory.fullpath.label('fullpath')).filter(Directory.filesystem_id == fs.id).filter(Directory.nfiles > 0)
+                all_files(q.filter(Directory._fullpath.isnot(None)).yield_per(1000),
+                          workers=options.jobs)
+                q = Session.query(Directory).filter(Directory.filesystem_id == fs.id).filter(Directory.nfiles > 0)
+                all_files(q.filter(Directory._fullpath.is_(None)).yield_per(1000),
+                          workers=options.jobs)
+                Session.commit()
+    #
+    # Always check for missing indexes, in case an earlier run that
+    # dropped them was interrupted.
+    #
+    for ix in indexes:
+        ix.create(Session.connection(), checkfirst=True)
+    Session.commit()
     #
     # Exit gracefully.
     #
     Session.close()
+    #
+    # Release the exclusive lock held by the pooled connection.
+    #
+    engine.dispose()
     return 0
@@ -0,0 +1,149 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+# -*- coding: utf-8 -*-
+"""
+comparator.test.test_find
+=========================
+
+Test comparator.find.
+"""
+import os
+import pytest
+from sqlalchemy import create_engine, text
+from ..db import Session, Base, FileSystem, Directory, File
+from ..find import walk, directories, files, all_files
+
+
+def _make_tree(top):
+    """Create a small directory tree containing files and symlinks.
+    """
+    for d in ('a/b/c', 'd'):
+        os.makedirs(os.path.join(top, d))
+    for f in ('f1', 'a/f2', 'a/b/c/f3', 'd/e'):
+        with open(os.path.join(top, f), 'w') as fd:
+            fd.write(f)
+    os.symlink('../f1', os.path.join(top, 'a', 'link1'))
+    os.symlink('a', os.path.join(top, 'dirlink'))
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_walk(tmp_path, workers):
+    """Test the order and contents of the directory walk.
+    """
+    top = str(tmp_path)
+    _make_tree(top)
+    result = [(dirpath, sorted(d.name for d in dirnames), sorted(f.name for f in filenames))
+              for dirpath, dirnames, filenames in walk(top, workers=workers, stat=True)]
+    expected = {top: (['a', 'd'], ['dirlink', 'f1']),
+                os.path.join(top, 'a'): (['b'], ['f2', 'link1']),
+                os.path.join(top, 'a', 'b'): (['c'], []),
+                os.path.join(top, 'a', 'b', 'c'): ([], ['f3']),
+                os.path.join(top, 'd'): ([], ['e'])}
+    assert len(result) == len(expected)
+    assert result[0][0] == top
+    for dirpath, dirnames, filenames in result:
+        assert expected[dirpath] == (dirnames, filenames)
+    #
+    # Parents are always visited before their children.
+    #
+    visited = [r[0] for r in result]
+    for i, dirpath in enumerate(visited[1:]):
+        assert os.path.dirname(dirpath) in visited[:i+1]
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_walk_prune(tmp_path, workers):
+    """Test that removing entries from dirnames prevents visiting them.
+    """
+    top = str(tmp_path)
+    _make_tree(top)
+    visited = []
+    for dirpath, dirnames, filenames in walk(top, workers=workers):
+        visited.append(dirpath)
+        dirnames[:] = [d for d in dirnames if d.name != 'a']
+    assert visited == [top, os.path.join(top, 'd')]
+
+
+def test_walk_missing(tmp_path):
+    """Test walking a directory that does not exist.
+    """
+    assert list(walk(str(tmp_path / 'missing'))) == []
+
+
+@pytest.fixture
+def session():
+    """Provide an empty, in-memory database.
+    """
+    engine = create_engine('sqlite://')
+    Session.remove()
+    Session.configure(bind=engine)
+    Base.metadata.create_all(engine)
+    yield Session
+    Session.remove()
+
+
+def test_directories(tmp_path, session):
+    """Test recording directories and files in the database.
+    """
+    top = str(tmp_path)
+    _make_tree(top)
+    fs = FileSystem(name=top)
+    session.add(fs)
+    session.commit()
+    last_id = directories(fs, batch_size=2)
+    assert last_id == 5
+    nfiles = {d.fullpath: d.nfiles for d in session.query(Directory).all()}
+    assert nfiles == {top: 2,
+                      os.path.join(top, 'a'): 2,
+                      os.path.join(top, 'a', 'b'): 0,
+                      os.path.join(top, 'a', 'b', 'c'): 1,
+                      os.path.join(top, 'd'): 1}
+    root = session.query(Directory).filter(Directory.name == '').one()
+    assert root.id == root.parent_id == 1
+    links = {f.name: f.destination for f in session.query(File).filter(File.link).all()}
+    assert links == {'dirlink': 'a', 'link1': '../f1'}
+    f3 = session.query(File).filter(File.name == 'f3').one()
+    assert f3.path == os.path.join(top, 'a', 'b', 'c', 'f3')
+    assert f3.size == 8
+
+
+def test_files(tmp_path, session):
+    """Test finding files after a directory-only scan.
+    """
+    top = str(tmp_path)
+    _make_tree(top)
+    fs = FileSystem(name=top)
+    session.add(fs)
+    session.commit()
+    directories(fs, skip_files=True)
+    assert session.query(File).count() == 0
+    for d in session.query(Directory).filter(Directory.nfiles > 0).all():
+        files(d, batch_size=1)
+    names = sorted(f.path for f in session.query(File).all())
+    assert names == sorted(os.path.join(top, f) for f in
+                           ('f1', 'dirlink', 'a/f2', 'a/link1', 'a/b/c/f3', 'd/e'))
+    session.query(File).delete()
+    all_files(session.query(Directory).filter(Directory.nfiles > 0).all(),
+              batch_size=2, workers=3)
+    assert sorted(f.path for f in session.query(File).all()) == names
+
+
+def test_fullpath_missing(tmp_path, session):
+    """Test reconstructing directory paths that were not stored.
+    """
+    top = str(tmp_path)
+    _make_tree(top)
+    fs = FileSystem(name=top + os.sep)
+    session.add(fs)
+    session.commit()
+    directories(fs, skip_files=True)
+    expected = {d.id: d.fullpath for d in session.query(Directory).all()}
+    assert expected[1] == fs.name
+    session.execute(text("UPDATE directory SET fullpath = NULL"))
+    session.expire_all()
+    for d in session.query(Directory).all():
+        d.__dict__.pop('fullpath', None)
+        assert d._fullpath is None
+        assert d.fullpath == expected[d.id]
+    assert sorted(expected.values()) == sorted([fs.name] +
+                                               [os.path.join(fs.name, p) for p in
+                                                ('a', 'a/b', 'a/b/c', 'd')])
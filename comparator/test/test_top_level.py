@@ -10,8 +10,10 @@ import re
 from .. import __version__ as theVersion
 
 
+_VERSION_RE = re.compile(r'([0-9]+!)?([0-9]+)(\.[0-9]+)*((a|b|rc|\.post|\.dev)[0-9]+)?')
+
+
 def test_version_string():
     """Ensure the version conforms to PEP386/PEP440.
     """
-    versionre = re.compile(r'([0-9]+!)?([0-9]+)(\.[0-9]+)*((a|b|rc|\.post|\.dev)[0-9]+)?')
-    assert versionre.match(theVersion) is not None
+    assert _VERSION_RE.match(theVersion) is not None